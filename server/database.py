@@ -7,63 +7,294 @@ sessions
   id             TEXT  PK
   user_id        TEXT  NOT NULL  (Clerk user ID)
   title          TEXT  NOT NULL
-  messages_json  TEXT  NOT NULL  (JSON array of {role, content})
+  messages_json  BLOB  NOT NULL  (JSON array of {role, content}; see _encode_messages)
   created_at     INTEGER NOT NULL  (unix ms)
   updated_at     INTEGER NOT NULL  (unix ms)
 """
 
-import json
 import os
+import queue
 import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+import orjson
+import zstandard as zstd
 
 DB_PATH = os.path.join(os.path.dirname(__file__), "chat_history.db")
+# Percent-escaped file: URI — a raw path containing '?', '#' or '%' would be misparsed
+_DB_URI = Path(DB_PATH).resolve().as_uri()
+
+
+def _usable_cores() -> int:
+    # Cores this process may run on — cpu_count() reports the whole host's
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:   # not available on macOS
+        return os.cpu_count() or 1
+
 
+# Read-only connections in the pool; main.py sizes its reader thread limiter to match
+READER_POOL_SIZE = _usable_cores()
 
-# ── Connection ──────────────────────────────────────────────────────────────
+# Applied once per connection — tuned for a small, write-heavy chat-history DB
+_PRAGMAS = (
+    "PRAGMA busy_timeout=5000",       # wait up to 5 s for a lock instead of SQLITE_BUSY
+    "PRAGMA cache_size=-20000",       # ~20 MB page cache
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",     # 256 MB memory-mapped I/O
+    "PRAGMA foreign_keys=ON",
+)
+_WRITER_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",        # readers never block the writer (and vice versa)
+    "PRAGMA synchronous=NORMAL",      # WAL + NORMAL: no fsync on every commit
+)
+_READER_PRAGMAS = (
+    "PRAGMA query_only=1",
+)
 
-def _get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+# Hot-path statements as module constants — the same str object on every call
+# keeps the per-connection compiled-statement cache hits cheap
+_SQL_GET = (
+    "SELECT id, title, messages_json, created_at, updated_at "
+    "FROM sessions WHERE user_id = ? ORDER BY updated_at DESC"
+)
+# Served from idx_sessions_user_list alone — never touches messages_json
+_SQL_LIST = (
+    "SELECT id, title, created_at, updated_at "
+    "FROM sessions WHERE user_id = ? ORDER BY updated_at DESC"
+)
+_SQL_GET_ONE = (
+    "SELECT id, title, messages_json, created_at, updated_at "
+    "FROM sessions WHERE id = ? AND user_id = ?"
+)
+_SQL_UPSERT = """
+    INSERT INTO sessions (id, user_id, title, messages_json, created_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        title         = excluded.title,
+        messages_json = excluded.messages_json,
+        updated_at    = excluded.updated_at
+"""
+_SQL_GET_MESSAGES = "SELECT messages_json FROM sessions WHERE id = ? AND user_id = ?"
+_SQL_SET_MESSAGES = (
+    "UPDATE sessions SET messages_json = ?, updated_at = ? WHERE id = ? AND user_id = ?"
+)
+_SQL_DELETE = "DELETE FROM sessions WHERE id = ? AND user_id = ?"
+
+
+def _connect(uri: str, pragmas: tuple[str, ...]) -> sqlite3.Connection:
+    # isolation_level=None → autocommit; no per-call commit() needed
+    conn = sqlite3.connect(
+        uri, uri=True, check_same_thread=False, isolation_level=None, cached_statements=128,
+    )
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")   # safe for concurrent async access
+    for pragma in pragmas + _PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
+# ── Writer — one connection behind a mutex (SQLite allows a single writer) ──
+_writer: sqlite3.Connection | None = None
+_write_lock = threading.Lock()
+
+
+def _get_writer() -> sqlite3.Connection:
+    global _writer
+    with _write_lock:
+        if _writer is None:
+            _writer = _connect(_DB_URI, _WRITER_PRAGMAS)
+    return _writer
+
+
+@contextmanager
+def _write_transaction():
+    """Yield the writer inside BEGIN IMMEDIATE … COMMIT, holding the write mutex."""
+    conn = _get_writer()
+    with _write_lock:
+        # BEGIN IMMEDIATE takes the write lock up front so a contended writer
+        # waits on busy_timeout rather than failing mid-transaction
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+# ── Readers — one read-only connection per CPU, handed out via a queue ─────
+
+class _ReaderPool:
+    """Fixed-size pool of read-only connections; WAL lets them run in parallel."""
+
+    def __init__(self, size: int):
+        self._queue: queue.Queue[sqlite3.Connection] = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._queue.put(_connect(f"{_DB_URI}?mode=ro", _READER_PRAGMAS))
+
+    @contextmanager
+    def connection(self):
+        conn = self._queue.get()
+        try:
+            yield conn
+        finally:
+            self._queue.put(conn)
+
+
+_readers: _ReaderPool | None = None
+_readers_lock = threading.Lock()
+
+
+def _get_readers() -> _ReaderPool:
+    global _readers
+    with _readers_lock:
+        if _readers is None:
+            _get_writer()   # mode=ro cannot create the file — make sure it exists
+            _readers = _ReaderPool(READER_POOL_SIZE)
+    return _readers
+
+
 # ── Bootstrap ───────────────────────────────────────────────────────────────
 
 def init_db() -> None:
-    """Create tables and indexes if they don't already exist."""
-    with _get_conn() as conn:
-        conn.execute("""
+    """Create tables and indexes if they don't already exist, then open the reader pool."""
+    conn = _get_writer()
+    with _write_lock:
+        # One round-trip for all DDL; executescript runs outside a transaction
+        conn.executescript("""
             CREATE TABLE IF NOT EXISTS sessions (
                 id            TEXT    PRIMARY KEY,
                 user_id       TEXT    NOT NULL,
                 title         TEXT    NOT NULL,
-                messages_json TEXT    NOT NULL DEFAULT '[]',
+                messages_json BLOB    NOT NULL DEFAULT X'5B5D',
                 created_at    INTEGER NOT NULL,
                 updated_at    INTEGER NOT NULL
-            )
+            );
+            -- Covering index: session listings are answered without a table lookup
+            CREATE INDEX IF NOT EXISTS idx_sessions_user_list
+                ON sessions(user_id, updated_at DESC, id, title, created_at);
         """)
+        _migrate(conn)
+    _get_readers()
+
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    """One-shot schema migrations, tracked via PRAGMA user_version."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        # v1: messages_json moved from TEXT to BLOB. SQLite can't change a
+        # column's declared type, but TEXT affinity keeps BLOB values as-is,
+        # so re-store existing rows as raw UTF-8 bytes.
         conn.execute(
-            "CREATE INDEX IF NOT EXISTS idx_sessions_user "
-            "ON sessions(user_id, updated_at DESC)"
+            "UPDATE sessions SET messages_json = CAST(messages_json AS BLOB) "
+            "WHERE typeof(messages_json) = 'text'"
         )
-        conn.commit()
+        conn.execute("PRAGMA user_version = 1")
+    if version < 2:
+        # v2: idx_sessions_user is a prefix of idx_sessions_user_list
+        conn.execute("DROP INDEX IF EXISTS idx_sessions_user")
+        conn.execute("PRAGMA user_version = 2")
+
+
+# ── messages_json codec ─────────────────────────────────────────────────────
+# Blobs start with a 1-byte format tag. Untagged blobs are legacy raw JSON —
+# a JSON array always starts with '[', so they can never collide with a tag.
+_FMT_ZSTD = 0x01
+_zstd_local = threading.local()   # zstd (de)compressor objects aren't thread-safe
+
+
+def _zstd_ctx() -> tuple[zstd.ZstdCompressor, zstd.ZstdDecompressor]:
+    ctx = getattr(_zstd_local, "ctx", None)
+    if ctx is None:
+        ctx = _zstd_local.ctx = (zstd.ZstdCompressor(level=3), zstd.ZstdDecompressor())
+    return ctx
+
+
+def _encode_messages(messages: list) -> bytes:
+    return bytes((_FMT_ZSTD,)) + _zstd_ctx()[0].compress(orjson.dumps(messages))
+
+
+def _decode_messages(blob: bytes) -> list:
+    if blob[:1] == bytes((_FMT_ZSTD,)):
+        return orjson.loads(_zstd_ctx()[1].decompress(blob[1:]))
+    return orjson.loads(blob)
+
+
+# ── Read cache — user_id -> (version, sessions), invalidated on every write ─
+_CACHE_MAX_USERS = 256
+_cache: OrderedDict[str, tuple[int, list[dict]]] = OrderedDict()
+_versions: dict[str, int] = {}
+_cache_lock = threading.Lock()
+
+
+def _invalidate(user_ids) -> None:
+    with _cache_lock:
+        for user_id in user_ids:
+            _versions[user_id] = _versions.get(user_id, 0) + 1
+            _cache.pop(user_id, None)
 
 
 # ── CRUD ────────────────────────────────────────────────────────────────────
 
+def _row_to_session(row: sqlite3.Row) -> dict:
+    return {
+        "id":        row["id"],
+        "title":     row["title"],
+        "messages":  _decode_messages(row["messages_json"]),
+        "createdAt": row["created_at"],
+        "updatedAt": row["updated_at"],
+    }
+
+
+def iter_sessions(user_id: str) -> Iterator[dict]:
+    """Yield sessions for *user_id*, newest first, fetching rows in batches."""
+    with _get_readers().connection() as conn:
+        cur = conn.execute(_SQL_GET, (user_id,))
+        cur.arraysize = 64
+        while rows := cur.fetchmany():
+            for row in rows:
+                yield _row_to_session(row)
+
+
 def get_sessions(user_id: str) -> list[dict]:
     """Return all sessions for *user_id*, newest first."""
-    with _get_conn() as conn:
-        rows = conn.execute(
-            "SELECT * FROM sessions WHERE user_id = ? ORDER BY updated_at DESC",
-            (user_id,),
-        ).fetchall()
+    return get_sessions_versioned(user_id)[1]
+
+
+def get_sessions_versioned(user_id: str) -> tuple[int, list[dict]]:
+    """
+    Return (version, sessions) for *user_id*, served from the in-process cache
+    when nothing was written for that user since the last read.
+    """
+    with _cache_lock:
+        version = _versions.get(user_id, 0)
+        cached = _cache.get(user_id)
+        if cached is not None and cached[0] == version:
+            _cache.move_to_end(user_id)
+            return cached
+    sessions = list(iter_sessions(user_id))
+    with _cache_lock:
+        # Only cache if no write landed while we were reading
+        if _versions.get(user_id, 0) == version:
+            _cache[user_id] = (version, sessions)
+            _cache.move_to_end(user_id)
+            while len(_cache) > _CACHE_MAX_USERS:
+                _cache.popitem(last=False)
+    return version, sessions
+
+
+def list_sessions(user_id: str) -> list[dict]:
+    """Return session metadata (no messages) for *user_id*, newest first."""
+    with _get_readers().connection() as conn:
+        rows = conn.execute(_SQL_LIST, (user_id,)).fetchall()
     return [
         {
             "id":        row["id"],
             "title":     row["title"],
-            "messages":  json.loads(row["messages_json"]),
             "createdAt": row["created_at"],
             "updatedAt": row["updated_at"],
         }
@@ -71,6 +302,13 @@ def get_sessions(user_id: str) -> list[dict]:
     ]
 
 
+def get_session(*, user_id: str, session_id: str) -> dict | None:
+    """Return one session with its messages, or None if it doesn't belong to *user_id*."""
+    with _get_readers().connection() as conn:
+        row = conn.execute(_SQL_GET_ONE, (session_id, user_id)).fetchone()
+    return _row_to_session(row) if row is not None else None
+
+
 def upsert_session(
     *,
     user_id:    str,
@@ -81,33 +319,53 @@ def upsert_session(
     updated_at: int,
 ) -> None:
     """Insert or update a session row."""
-    with _get_conn() as conn:
+    upsert_sessions_bulk([(session_id, user_id, title, messages, created_at, updated_at)])
+
+
+def upsert_sessions_bulk(rows: list[tuple]) -> None:
+    """
+    Insert or update many sessions in a single transaction.
+    Each row is (session_id, user_id, title, messages, created_at, updated_at).
+    """
+    # Encode outside the write lock — compression is the expensive part
+    params = [
+        (session_id, user_id, title, _encode_messages(messages), created_at, updated_at)
+        for session_id, user_id, title, messages, created_at, updated_at in rows
+    ]
+    with _write_transaction() as conn:
+        conn.executemany(_SQL_UPSERT, params)
+    _invalidate({row[1] for row in rows})
+
+
+def append_message(
+    *,
+    user_id:    str,
+    session_id: str,
+    message:    dict,
+    updated_at: int,
+) -> bool:
+    """
+    Append one message to an existing session. Returns False if the session
+    doesn't exist for *user_id* (caller should fall back to a full upsert).
+    """
+    # Blobs are zstd-compressed, so SQLite's json_insert can't edit them in
+    # place — decode/append/encode inside one write transaction instead.
+    with _write_transaction() as conn:
+        row = conn.execute(_SQL_GET_MESSAGES, (session_id, user_id)).fetchone()
+        if row is None:
+            return False
+        messages = _decode_messages(row["messages_json"])
+        messages.append(message)
         conn.execute(
-            """
-            INSERT INTO sessions (id, user_id, title, messages_json, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ON CONFLICT(id) DO UPDATE SET
-                title         = excluded.title,
-                messages_json = excluded.messages_json,
-                updated_at    = excluded.updated_at
-            """,
-            (
-                session_id,
-                user_id,
-                title,
-                json.dumps(messages),
-                created_at,
-                updated_at,
-            ),
+            _SQL_SET_MESSAGES,
+            (_encode_messages(messages), updated_at, session_id, user_id),
         )
-        conn.commit()
+    _invalidate((user_id,))
+    return True
 
 
 def delete_session(*, user_id: str, session_id: str) -> None:
     """Delete a session only if it belongs to *user_id*."""
-    with _get_conn() as conn:
-        conn.execute(
-            "DELETE FROM sessions WHERE id = ? AND user_id = ?",
-            (session_id, user_id),
-        )
-        conn.commit()
+    with _write_transaction() as conn:
+        conn.execute(_SQL_DELETE, (session_id, user_id))
+    _invalidate((user_id,))
@@ -1,29 +1,63 @@
+import asyncio
 import os
-import shutil
-import json
 import time
+from contextlib import asynccontextmanager, suppress
+from functools import cache, partial
+from pathlib import Path
+from stat import S_ISREG
+from typing import Literal
+
+import anyio
+import anyio.to_thread
+import orjson
 
 from dotenv import load_dotenv
 load_dotenv()
 
-from fastapi import FastAPI, File, UploadFile, BackgroundTasks, HTTPException
+from fastapi import (
+    FastAPI, File, UploadFile, BackgroundTasks, HTTPException, Header, Response,
+    WebSocket, WebSocketDisconnect,
+)
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, StreamingResponse, FileResponse
+from pydantic import BaseModel, TypeAdapter, ValidationError
 
 from worker import (
     process_pdf, stream_chat_with_pdf, get_suggestions,
     get_embedding_status, list_embedded_pdfs, delete_pdf_from_collection,
-    merge_pdfs, translate_pdf_stream, UPLOAD_DIR,
+    merge_pdfs, translate_pdf_stream, warmup, UPLOAD_DIR,
 )
 
 WORKER_UPLOAD_DIR = UPLOAD_DIR
-from database import init_db, get_sessions, upsert_session, delete_session
+UPLOAD_ROOT = Path(WORKER_UPLOAD_DIR).resolve()   # resolved once, reused per download
+from database import (
+    init_db, get_sessions_versioned, list_sessions, get_session, upsert_sessions_bulk,
+    append_message, delete_session, READER_POOL_SIZE,
+)
 
 # ──────────────────────────────────────────────
 # App setup
 # ──────────────────────────────────────────────
-app = FastAPI(title="PDF RAG API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Background consumer for the chat-history write-back queue
+    writer_task = asyncio.create_task(_session_writer())
+    # Load the embedding model and open connections while the server starts
+    # accepting requests; anything arriving earlier waits on the singleton locks
+    warmup_task = asyncio.create_task(asyncio.to_thread(warmup))
+    yield
+    # Flush whatever is still queued before the process exits — first, so a
+    # slow warmup can't eat into the shutdown grace period
+    _session_queue.put_nowait(None)
+    _session_flush.set()
+    await writer_task
+    # The warmup thread itself can't be interrupted; just stop waiting for it
+    warmup_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await warmup_task
+
+
+app = FastAPI(title="PDF RAG API", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # Initialise SQLite chat-history database
 init_db()
@@ -35,6 +69,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ──────────────────────────────────────────────
+# Stream framing — emit bytes so Starlette sends them without re-encoding
+# ──────────────────────────────────────────────
+_SSE_DONE = b"data: [DONE]\n\n"
+_WS_DONE = orjson.dumps({"type": "done"})
+
+
+def _sse_frame(event: dict) -> bytes:
+    return b"data: " + orjson.dumps(event, option=orjson.OPT_APPEND_NEWLINE) + b"\n"
+
+
 # ──────────────────────────────────────────────
 # Routes
 # ──────────────────────────────────────────────
@@ -54,8 +99,10 @@ async def upload_pdf(background_tasks: BackgroundTasks, pdf: UploadFile = File(.
         raise HTTPException(status_code=400, detail="Only PDF files are accepted.")
 
     file_path = os.path.join(UPLOAD_DIR, pdf.filename)
-    with open(file_path, "wb") as f:
-        shutil.copyfileobj(pdf.file, f)
+    # Copy in 1 MiB chunks without blocking the event loop
+    async with await anyio.open_file(file_path, "wb") as f:
+        while chunk := await pdf.read(1 << 20):
+            await f.write(chunk)
 
     # Process (chunk + embed) the PDF in the background
     background_tasks.add_task(process_pdf, file_path)
@@ -79,10 +126,23 @@ def remove_pdf(filename: str):
 @app.get("/pdf/download/{filename}")
 def download_pdf(filename: str):
     """Serve a PDF file from the uploads directory."""
-    file_path = os.path.join(WORKER_UPLOAD_DIR, filename)
-    if not os.path.exists(file_path):
+    # Keep only the basename so '../' can't escape the uploads directory
+    file_path = UPLOAD_ROOT / Path(filename).name
+    try:
+        stat_result = file_path.stat()
+    except FileNotFoundError:
+        stat_result = None
+    if stat_result is None or not S_ISREG(stat_result.st_mode):
         raise HTTPException(status_code=404, detail="File not found.")
-    return FileResponse(file_path, media_type="application/pdf", filename=filename)
+    # Passing stat_result skips Starlette's own stat; the body goes out via
+    # sendfile(2) and Range requests let the browser fetch PDFs progressively.
+    return FileResponse(
+        file_path,
+        media_type="application/pdf",
+        filename=file_path.name,
+        stat_result=stat_result,
+        headers={"Accept-Ranges": "bytes"},
+    )
 
 
 class MergeRequest(BaseModel):
@@ -117,8 +177,8 @@ async def translate_pdf(req: TranslateRequest):
 
     async def event_generator():
         async for event in translate_pdf_stream(req.filename, req.language):
-            yield f"data: {json.dumps(event)}\n\n"
-        yield "data: [DONE]\n\n"
+            yield _sse_frame(event)
+        yield _SSE_DONE
 
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
@@ -132,9 +192,18 @@ def upload_status(filename: str):
     return {"filename": filename, "status": status}
 
 
+class ChatMessage(BaseModel):
+    role:    Literal["user", "assistant", "system"]
+    content: str
+
+
+# Dumps a whole message list back to plain dicts in one pydantic-core call
+_messages_adapter = TypeAdapter(list[ChatMessage])
+
+
 class ChatRequest(BaseModel):
     message: str
-    history: list = []        # list of {role, content} dicts for conversation memory
+    history: list[ChatMessage] = []   # conversation memory
     active_pdfs: list = []   # list of server-side filenames currently active in the UI
 
 
@@ -150,18 +219,59 @@ async def chat_stream(req: ChatRequest):
     async def event_generator():
         try:
             async for event in stream_chat_with_pdf(
-                req.message, req.history, req.active_pdfs or None
+                req.message,
+                _messages_adapter.dump_python(req.history),
+                req.active_pdfs or None,
             ):
                 # event is already {"type": "token"|"sources", "data": ...}
-                yield f"data: {json.dumps(event)}\n\n"
+                yield _sse_frame(event)
         except Exception as exc:
             # Surface the error as an SSE event so the frontend can display it
-            yield f"data: {json.dumps({'type': 'error', 'data': str(exc)})}\n\n"
-        yield "data: [DONE]\n\n"
+            yield _sse_frame({"type": "error", "data": str(exc)})
+        yield _SSE_DONE
 
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
 
+@app.websocket("/chat/ws")
+async def chat_ws(ws: WebSocket):
+    """
+    WebSocket version of /chat/stream — one binary orjson frame per event, no
+    SSE framing. Each ChatRequest frame is answered with its events followed
+    by {"type": "done"}; the socket stays open for the next question.
+    """
+    await ws.accept()
+    try:
+        while True:
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            try:
+                req = ChatRequest.model_validate_json(message.get("bytes") or message.get("text") or "")
+            except ValidationError as exc:
+                await ws.send_bytes(orjson.dumps({"type": "error", "data": str(exc)}))
+                await ws.send_bytes(_WS_DONE)
+                continue
+            if not req.message.strip():
+                await ws.send_bytes(orjson.dumps({"type": "error", "data": "message is required."}))
+                await ws.send_bytes(_WS_DONE)
+                continue
+            try:
+                async for event in stream_chat_with_pdf(
+                    req.message,
+                    _messages_adapter.dump_python(req.history),
+                    req.active_pdfs or None,
+                ):
+                    await ws.send_bytes(orjson.dumps(event))
+            except WebSocketDisconnect:
+                raise
+            except Exception as exc:
+                await ws.send_bytes(orjson.dumps({"type": "error", "data": str(exc)}))
+            await ws.send_bytes(_WS_DONE)
+    except WebSocketDisconnect:
+        pass
+
+
 @app.get("/suggestions")
 async def suggestions(message: str, answer: str):
     """
@@ -178,42 +288,209 @@ async def suggestions(message: str, answer: str):
 # Chat-history routes  (per-user, stored in SQLite)
 # ──────────────────────────────────────────────
 
+_BOOT_ID = format(time.time_ns(), "x")
+
+
+@cache
+def _db_limiters() -> tuple[anyio.CapacityLimiter, anyio.CapacityLimiter]:
+    """
+    Thread limiters mirroring database.py's pools: N readers, a single writer.
+    Created lazily so they bind to the running event loop.
+    """
+    return anyio.CapacityLimiter(READER_POOL_SIZE), anyio.CapacityLimiter(1)
+
+
+# ── Write-back queue — coalesces bursts of session saves into one transaction ──
+SESSION_FLUSH_INTERVAL = 0.25   # seconds
+
+# Items are (rows, future-or-None); None is the shutdown sentinel
+_session_queue: asyncio.Queue[tuple[list[tuple], asyncio.Future | None] | None] = asyncio.Queue()
+_session_flush = asyncio.Event()   # set to cut the coalescing window short
+
+
+async def _session_writer() -> None:
+    """Drain queued saves in windows, keeping only the latest row per session_id."""
+    _, writer = _db_limiters()
+    stopping = False
+    while not stopping:
+        item = await _session_queue.get()
+        if item is None:
+            break
+        batch = [item]
+        try:
+            await asyncio.wait_for(_session_flush.wait(), SESSION_FLUSH_INTERVAL)
+        except TimeoutError:
+            pass
+        _session_flush.clear()
+        while not _session_queue.empty():
+            item = _session_queue.get_nowait()
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+
+        try:
+            await _write_session_batch(batch, writer)
+        except Exception as exc:
+            # Keep consuming — if this task died, queued saves would never be written
+            print(f"[main] Session writer error: {exc}")
+
+
+async def _write_session_batch(batch: list, writer: anyio.CapacityLimiter) -> None:
+    latest: dict[str, tuple] = {}
+    for rows, _ in batch:
+        for row in rows:
+            latest[row[0]] = row
+    waiters = [fut for _, fut in batch if fut is not None]
+    try:
+        if latest:
+            await anyio.to_thread.run_sync(
+                upsert_sessions_bulk, list(latest.values()), limiter=writer
+            )
+    except Exception as exc:
+        print(f"[main] Session write-back failed: {exc}")
+        for fut in waiters:
+            if not fut.done():   # the caller may have been cancelled meanwhile
+                fut.set_exception(exc)
+    else:
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(None)
+
+
+async def _queue_sessions(rows: list[tuple], flush: bool = False) -> None:
+    """Queue session rows; with flush=True, wait until they (and everything before them) are committed."""
+    if not flush:
+        _session_queue.put_nowait((rows, None))
+        return
+    fut = asyncio.get_running_loop().create_future()
+    _session_queue.put_nowait((rows, fut))
+    _session_flush.set()
+    await fut
+
+
 class SessionPayload(BaseModel):
     user_id:    str
     session_id: str
     title:      str
-    messages:   list
+    messages:   list[ChatMessage]
     created_at: int
 
 
 @app.get("/history")
-def get_history(user_id: str):
-    """Return all saved chat sessions for a Clerk user."""
+async def get_history(
+    user_id: str,
+    response: Response,
+    if_none_match: str | None = Header(default=None),
+):
+    """Return all saved chat sessions for a Clerk user (ETag / 304 aware)."""
+    if not user_id.strip():
+        raise HTTPException(status_code=400, detail="user_id is required.")
+    readers, _ = _db_limiters()
+    version, sessions = await anyio.to_thread.run_sync(
+        get_sessions_versioned, user_id, limiter=readers
+    )
+    # Versions restart at 0 with the process — scope the tag to this boot
+    etag = f'"{_BOOT_ID}-{version}"'
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return {"sessions": sessions}
+
+
+@app.get("/history/sessions")
+async def list_history(user_id: str):
+    """List a Clerk user's sessions without their messages (id, title, timestamps)."""
+    if not user_id.strip():
+        raise HTTPException(status_code=400, detail="user_id is required.")
+    readers, _ = _db_limiters()
+    sessions = await anyio.to_thread.run_sync(list_sessions, user_id, limiter=readers)
+    return {"sessions": sessions}
+
+
+@app.get("/history/session/{session_id}")
+async def get_history_session(session_id: str, user_id: str):
+    """Return one chat session with its messages (only if it belongs to user_id)."""
     if not user_id.strip():
         raise HTTPException(status_code=400, detail="user_id is required.")
-    return {"sessions": get_sessions(user_id)}
+    readers, _ = _db_limiters()
+    session = await anyio.to_thread.run_sync(
+        partial(get_session, user_id=user_id, session_id=session_id),
+        limiter=readers,
+    )
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found.")
+    return session
 
 
 @app.post("/history/session")
-def save_session(payload: SessionPayload):
-    """Create or update a chat session (upsert by session_id)."""
+async def save_session(payload: SessionPayload, response: Response, flush: bool = False):
+    """
+    Create or update a chat session (upsert by session_id).
+    Saves are queued and coalesced (202); pass flush=true (e.g. when the user
+    navigates away) to wait until the session is committed.
+    """
+    return await save_sessions([payload], response, flush)
+
+
+@app.post("/history/sessions")
+async def save_sessions(payloads: list[SessionPayload], response: Response, flush: bool = False):
+    """Create or update many chat sessions in one transaction (bulk import / sync)."""
+    if any(not p.user_id.strip() for p in payloads):
+        raise HTTPException(status_code=400, detail="user_id is required.")
+    updated_at = int(time.time() * 1000)
+    rows = [
+        (p.session_id, p.user_id, p.title, _messages_adapter.dump_python(p.messages),
+         p.created_at, updated_at)
+        for p in payloads
+    ]
+    await _queue_sessions(rows, flush)
+    if not flush:
+        response.status_code = 202
+        return {"status": "queued"}
+    return {"status": "ok"}
+
+
+class AppendMessagePayload(BaseModel):
+    user_id: str
+    message: ChatMessage
+
+
+@app.post("/history/session/{session_id}/messages")
+async def append_session_message(session_id: str, payload: AppendMessagePayload):
+    """
+    Append one message to an existing session — only the new message travels
+    over the wire. Returns 404 if the session doesn't exist yet; create it (or
+    rename it) with POST /history/session instead.
+    """
     if not payload.user_id.strip():
         raise HTTPException(status_code=400, detail="user_id is required.")
-    upsert_session(
-        user_id    = payload.user_id,
-        session_id = payload.session_id,
-        title      = payload.title,
-        messages   = payload.messages,
-        created_at = payload.created_at,
-        updated_at = int(time.time() * 1000),
+    await _queue_sessions([], flush=True)   # land queued saves first so they can't clobber this
+    _, writer = _db_limiters()
+    appended = await anyio.to_thread.run_sync(
+        partial(
+            append_message,
+            user_id    = payload.user_id,
+            session_id = session_id,
+            message    = payload.message.model_dump(),
+            updated_at = int(time.time() * 1000),
+        ),
+        limiter=writer,
     )
+    if not appended:
+        raise HTTPException(status_code=404, detail="Session not found.")
     return {"status": "ok"}
 
 
 @app.delete("/history/session/{session_id}")
-def delete_session_route(session_id: str, user_id: str):
+async def delete_session_route(session_id: str, user_id: str):
     """Permanently delete one chat session (only if it belongs to user_id)."""
     if not user_id.strip():
         raise HTTPException(status_code=400, detail="user_id is required.")
-    delete_session(user_id=user_id, session_id=session_id)
+    await _queue_sessions([], flush=True)   # a queued save must not resurrect the session
+    _, writer = _db_limiters()
+    await anyio.to_thread.run_sync(
+        partial(delete_session, user_id=user_id, session_id=session_id),
+        limiter=writer,
+    )
     return {"status": "ok"}
@@ -1,32 +1,89 @@
 import asyncio
+import hashlib
 import os
+import re
 import uuid
 import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, nullcontext, suppress
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import numpy as np
+import orjson
 from fastembed import TextEmbedding
-from langchain_core.embeddings import Embeddings
 from langchain_community.document_loaders import PyPDFLoader
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from tokenizers import Tokenizer
 from langchain_groq import ChatGroq
-from langchain_qdrant import QdrantVectorStore
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient, QdrantClient
 from qdrant_client.models import (
     Distance, VectorParams, PointStruct,
-    Filter, FieldCondition, MatchValue,
-    FilterSelector,
+    Filter, FieldCondition, MatchValue, MatchAny,
+    FilterSelector, PointIdsList, OptimizersConfigDiff, PayloadSchemaType,
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType,
 )
 
 # Read from env so local dev and cloud both work without code changes
 QDRANT_URL  = os.getenv("QDRANT_URL",  "http://localhost:6333")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY", None)
+# gRPC (binary protobuf over one multiplexed HTTP/2 connection) — set to "false"
+# if a proxy in front of Qdrant only passes REST
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "true").lower() != "false"
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
+QDRANT_TIMEOUT = 12  # seconds — fail fast on Render free tier instead of hanging
 COLLECTION  = "pdf-rag"
 EMBED_MODEL = "nomic-ai/nomic-embed-text-v1.5"  # original local model
 CHAT_MODEL  = "llama-3.3-70b-versatile"  # Groq free tier — very fast
 VECTOR_SIZE = 768                         # nomic-embed-text output dimension
 UPLOAD_DIR  = os.path.join(os.path.dirname(__file__), "uploads")
+EXTRACT_CACHE_DIR = os.path.join(UPLOAD_DIR, ".cache")   # PyPDF output keyed by SHA-256
+EXTRACT_CACHE_MAX_ENTRIES = 64            # least recently used entries beyond this are evicted
+# Chunk sizes are in model tokens — FastEmbed truncates inputs at 512 tokens
+CHUNK_SIZE       = 400
+CHUNK_OVERLAP    = 40
+CHUNK_MIN_TOKENS = 100                    # smaller chunks are merged into their neighbour
+CHUNK_MAX_TOKENS = 500
+INDEXING_THRESHOLD = 20000                # Qdrant default (KB) — used if the saved value was 0
+BULK_INDEXING_MIN_POINTS = 500            # below this, pausing HNSW indexing isn't worth it
+PIPELINE_BATCH = 64                       # chunks per embed → upsert slice on large PDFs
+PIPELINE_MIN_CHUNKS = 2 * PIPELINE_BATCH  # below this, embed-all-then-upsert is simpler
+# Multi-process embedding is opt-in: every worker process loads its own copy of
+# the model (~0.5 GB). Unset = embed in-process; "auto" = one per usable core - 1.
+EMBED_PARALLEL = os.getenv("EMBED_PARALLEL", "").strip().lower()
+PARALLEL_MIN_CHUNKS = 512                 # below this, worker spawn + model load costs more
+RETRIEVAL_CACHE_TTL = 60.0                # seconds a cached per-PDF search stays valid
+RETRIEVAL_CACHE_MAX = 256
 
 # ── FastEmbed singleton ───────────────────────────────────────────────────────
 _fastembed_model: TextEmbedding | None = None
 _fastembed_lock = threading.Lock()
+# Ingestion embedding runs here — one at a time, since each run saturates the CPU
+_embed_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed")
+
+
+# ── Tokenizer singleton — measures chunk sizes in the embedding model's tokens ─
+_tokenizer: Tokenizer | None = None
+_tokenizer_lock = threading.Lock()
+
+
+def _get_tokenizer() -> Tokenizer:
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            # Copy FastEmbed's tokenizer (loaded from the model cache baked in at
+            # build time) rather than fetching tokenizer.json from the HF hub
+            onnx_tokenizer = _get_fastembed_model().model.tokenizer
+            _tokenizer = Tokenizer.from_str(onnx_tokenizer.to_str())
+            _tokenizer.no_truncation()
+            _tokenizer.no_padding()
+    return _tokenizer
+
+
+def _token_len(text: str) -> int:
+    return len(_get_tokenizer().encode(text, add_special_tokens=False).ids)
 
 
 def _get_fastembed_model() -> TextEmbedding:
@@ -40,29 +97,99 @@ def _get_fastembed_model() -> TextEmbedding:
     return _fastembed_model
 
 
-def _batch_embed(texts: list[str]) -> list[list[float]]:
-    """Embed texts via FastEmbed (model cached on disk from build time)."""
+def _batch_embed_np(texts: list[str]) -> np.ndarray:
+    """Embed texts via FastEmbed into one contiguous (N, VECTOR_SIZE) float32 matrix."""
+    if not texts:
+        return np.empty((0, VECTOR_SIZE), dtype=np.float32)
     model = _get_fastembed_model()
-    return [v.tolist() for v in model.embed(texts)]
+    return np.stack(list(model.embed(texts)))
+
+
+def _embed_parallelism(n_chunks: int) -> int | None:
+    """Worker-process count for an ingest of n_chunks, or None to embed in-process."""
+    if not EMBED_PARALLEL or n_chunks < PARALLEL_MIN_CHUNKS:
+        return None
+    if EMBED_PARALLEL == "auto":
+        # Cores this process may actually run on — os.cpu_count() reports the host's
+        try:
+            cores = len(os.sched_getaffinity(0))
+        except AttributeError:   # not available on macOS
+            cores = os.cpu_count() or 1
+        return max(1, cores - 1)
+    return int(EMBED_PARALLEL)
+
 
+def _batch_embed_bulk(texts: list[str], parallel: int | None = None) -> np.ndarray:
+    """
+    Ingestion path: FastEmbed in-process, or data-parallel across `parallel`
+    worker processes. Run with OMP_NUM_THREADS=1 when parallel > 1 so the workers
+    don't oversubscribe cores. Queries go through _embed_query → _batch_embed_np
+    (one process, intra-op threads).
+    """
+    out = np.empty((len(texts), VECTOR_SIZE), dtype=np.float32)
+    for indices, vectors in _embed_bulk_stream(texts, parallel, max(len(texts), 1)):
+        out[indices] = vectors   # undo the length sort
+    return out
+
+
+def _embed_bulk_stream(
+    texts: list[str], parallel: int | None, slice_size: int,
+) -> Iterator[tuple[list[int], np.ndarray]]:
+    """
+    Like _batch_embed_bulk, but yields (indices, matrix) slices of up to
+    slice_size rows as FastEmbed produces them; indices map rows back to texts.
+
+    Texts are embedded shortest-first ("smart batching"): ONNX pads each batch
+    to its longest member, so grouping similar lengths cuts wasted attention work.
+    """
+    model = _get_fastembed_model()
+    if parallel is not None and parallel <= 1:
+        parallel = None   # a single worker process is pure spawn overhead
+    order = list(range(len(texts)))
+    if len(texts) >= 8:   # too few texts to be worth reordering
+        order.sort(key=lambda i: len(texts[i]))
+    buf = []
+    start = 0
+    for vec in model.embed([texts[i] for i in order], batch_size=32, parallel=parallel):
+        buf.append(vec)
+        if len(buf) == slice_size:
+            yield order[start:start + len(buf)], np.stack(buf)
+            start += len(buf)
+            buf = []
+    if buf:
+        yield order[start:start + len(buf)], np.stack(buf)
+
+
+def _normalize_query(text: str) -> str:
+    # The model's tokenizer is uncased and whitespace-insensitive, so this
+    # only widens cache hits without changing the embedding
+    return " ".join(text.lower().split())
+
+
+@lru_cache(maxsize=1024)
+def _embed_query_cached(normalized_query: str) -> np.ndarray:
+    # float32 array (~3 KB) rather than a tuple of 768 Python floats (~25 KB);
+    # read-only because every caller shares the cached object
+    vector = _batch_embed_np([normalized_query])[0].astype(np.float32, copy=False)
+    vector.flags.writeable = False
+    return vector
+
+
+def _embed_query(text: str) -> list[float]:
+    """Embed a search query, skipping FastEmbed for repeat questions (exact-match LRU)."""
+    return _embed_query_cached(_normalize_query(text)).tolist()
 
-class _FastEmbeddings(Embeddings):
-    """Thin LangChain Embeddings wrapper around _batch_embed."""
-    def embed_documents(self, texts: list[str]) -> list[list[float]]:
-        return _batch_embed(texts)
-    def embed_query(self, text: str) -> list[float]:
-        return _batch_embed([text])[0]
 
 # ── Singletons — created once, reused on every request ──────────────────────
 _qdrant_client: QdrantClient | None = None
-_vector_store: QdrantVectorStore | None = None
+_async_qdrant_client: AsyncQdrantClient | None = None
 _llm: ChatGroq | None = None
 
 # ── Embedding status tracking (⌑16) ───────────────────────────────────────────────
 _embedding_status: dict[str, str] = {}   # basename -> 'processing' | 'done' | 'error'
 _embedding_lock = threading.Lock()
 # None = not yet loaded from Qdrant; populated lazily on first access after restart.
-_embedded_pdfs: list[str] | None = None
+_embedded_pdfs: set[str] | None = None
 
 
 def get_embedding_status(filename: str) -> str:
@@ -70,13 +197,13 @@ def get_embedding_status(filename: str) -> str:
     return _embedding_status.get(filename, 'unknown')
 
 
-def _reload_pdfs_from_qdrant() -> list[str]:
+def _reload_pdfs_from_qdrant() -> set[str]:
     """Scroll Qdrant once to recover all unique PDF filenames after a server restart."""
     try:
         client = get_qdrant_client()
         existing = [c.name for c in client.get_collections().collections]
         if COLLECTION not in existing:
-            return []
+            return set()
         seen: set[str] = set()
         offset = None
         while True:
@@ -97,27 +224,82 @@ def _reload_pdfs_from_qdrant() -> list[str]:
                 break
             offset = next_offset
         print(f"[worker] Reloaded {len(seen)} PDFs from Qdrant.")
-        return list(seen)
+        return seen
     except Exception as exc:
         print(f"[worker] Could not reload PDF list from Qdrant: {exc}")
-        return []
+        return set()
 
 
 def _ensure_pdfs_loaded() -> None:
     """Lazily initialise _embedded_pdfs from Qdrant if not yet loaded (e.g. after restart)."""
     global _embedded_pdfs
     if _embedded_pdfs is None:
-        _embedded_pdfs = _reload_pdfs_from_qdrant()
+        loaded = _reload_pdfs_from_qdrant()   # network round-trips — don't hold the lock
+        with _embedding_lock:
+            if _embedded_pdfs is None:
+                _embedded_pdfs = loaded
+
+
+_QDRANT_KWARGS = dict(
+    url=QDRANT_URL,
+    api_key=QDRANT_API_KEY or None,
+    prefer_grpc=QDRANT_PREFER_GRPC,
+    grpc_port=QDRANT_GRPC_PORT,
+    timeout=QDRANT_TIMEOUT,
+)
+_qdrant_lock = threading.Lock()
 
 
 def get_qdrant_client() -> QdrantClient:
     global _qdrant_client
-    if _qdrant_client is None:
-        _qdrant_client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY or None)
-        print(f"[worker] Qdrant connected → {QDRANT_URL}")
+    with _qdrant_lock:
+        if _qdrant_client is None:
+            _qdrant_client = QdrantClient(**_QDRANT_KWARGS)
+            print(f"[worker] Qdrant connected → {QDRANT_URL} (gRPC={QDRANT_PREFER_GRPC})")
     return _qdrant_client
 
 
+def get_async_qdrant_client() -> AsyncQdrantClient:
+    """Async twin of get_qdrant_client — only use it from the server's event loop."""
+    global _async_qdrant_client
+    with _qdrant_lock:
+        if _async_qdrant_client is None:
+            _async_qdrant_client = AsyncQdrantClient(**_QDRANT_KWARGS)
+    return _async_qdrant_client
+
+
+# Keyword payload indexes — 'filename' backs per-PDF filtered retrieval and
+# deletes, 'metadata.source' covers points that pre-date the 'filename' field
+PAYLOAD_INDEXES = ("filename", "metadata.source")
+
+
+def _ensure_payload_indexes(client: QdrantClient, existing: dict | None = None) -> None:
+    for field in PAYLOAD_INDEXES:
+        if existing and field in existing:
+            continue
+        client.create_payload_index(
+            collection_name=COLLECTION,
+            field_name=field,
+            field_schema=PayloadSchemaType.KEYWORD,
+        )
+
+
+# int8 copies of the vectors stay in RAM for the HNSW search (4x smaller than
+# float32); Qdrant rescores the top candidates with the originals
+QUANTIZATION = ScalarQuantization(
+    scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True),
+)
+
+
+def _create_collection(client: QdrantClient) -> None:
+    client.create_collection(
+        collection_name=COLLECTION,
+        vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE),
+        quantization_config=QUANTIZATION,
+    )
+    _ensure_payload_indexes(client)
+
+
 def ensure_collection(client: QdrantClient):
     existing = {c.name: c for c in client.get_collections().collections}
     if COLLECTION in existing:
@@ -127,33 +309,19 @@ def ensure_collection(client: QdrantClient):
         if current_size != VECTOR_SIZE:
             print(f"[worker] Collection vector size mismatch ({current_size} vs {VECTOR_SIZE}) — recreating.")
             client.delete_collection(COLLECTION)
-            client.create_collection(
-                collection_name=COLLECTION,
-                vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE),
-            )
+            _create_collection(client)
             print(f"[worker] Collection '{COLLECTION}' recreated with size={VECTOR_SIZE}.")
+        else:
+            # Collections created before the payload indexes existed get them now
+            _ensure_payload_indexes(client, info.payload_schema)
+            if info.config.quantization_config is None:
+                client.update_collection(COLLECTION, quantization_config=QUANTIZATION)
+                print(f"[worker] Enabled int8 quantization on '{COLLECTION}'.")
     else:
-        client.create_collection(
-            collection_name=COLLECTION,
-            vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE),
-        )
+        _create_collection(client)
         print(f"[worker] Collection '{COLLECTION}' created with size={VECTOR_SIZE}.")
 
 
-def get_vector_store() -> QdrantVectorStore:
-    global _vector_store
-    if _vector_store is None:
-        client = get_qdrant_client()
-        ensure_collection(client)
-        _vector_store = QdrantVectorStore(
-            client=client,
-            collection_name=COLLECTION,
-            embedding=_FastEmbeddings(),
-        )
-        print("[worker] Vector store initialised.")
-    return _vector_store
-
-
 def get_llm() -> ChatGroq:
     global _llm
     if _llm is None:
@@ -169,67 +337,416 @@ def get_llm() -> ChatGroq:
     return _llm
 
 
+def warmup() -> None:
+    """
+    Build the FastEmbed, Qdrant and Groq singletons ahead of the first request.
+    One throwaway embedding makes ONNX allocate its session buffers now too.
+    """
+    steps = (
+        ("FastEmbed", lambda: _batch_embed_np(["warmup"])),
+        ("Qdrant", lambda: get_qdrant_client().get_collections()),
+        ("LLM", get_llm),
+    )
+    for name, step in steps:
+        try:
+            step()
+        except Exception as exc:
+            # Not fatal — the first request retries the lazy initialisation
+            print(f"[worker] {name} warmup failed: {exc}")
+    print("[worker] Warmup complete.")
+
+
 # ── PDF ingestion ────────────────────────────────────────────────────────────
 
-def process_pdf(file_path: str):
-    """Load, chunk and embed a PDF file into Qdrant. Called as a background task."""
+def _load_and_split(file_path: str) -> list:
+    """Load a PDF and split it into chunks (CPU-bound — run off the event loop)."""
+    # ── 1. Load ──────────────────────────────────────────────────────────────
+    loader = PyPDFLoader(file_path)
+    docs = loader.load()
+
+    # ── 2. Split by model tokens so no chunk is silently truncated ───────────
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        length_function=_token_len,
+    )
+    return _merge_small_chunks(splitter.split_documents(docs))
+
+
+def _merge_small_chunks(chunks: list) -> list:
+    """Fold chunks under CHUNK_MIN_TOKENS into the previous chunk of the same file."""
+    merged: list = []
+    merged_len: list[int] = []
+    for chunk in chunks:
+        n = _token_len(chunk.page_content)
+        if (
+            merged
+            and n < CHUNK_MIN_TOKENS
+            and merged[-1].metadata.get("source") == chunk.metadata.get("source")
+            and merged_len[-1] + n <= CHUNK_MAX_TOKENS
+        ):
+            merged[-1].page_content += "\n" + chunk.page_content
+            merged_len[-1] += n
+        else:
+            merged.append(chunk)
+            merged_len.append(n)
+    return merged
+
+
+# ── Extraction cache — PyPDF output keyed by the file's SHA-256 ──────────────
+
+def _file_sha256(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _cache_load(name: str) -> list | None:
+    path = os.path.join(EXTRACT_CACHE_DIR, name)
+    try:
+        with open(path, "rb") as f:
+            value = orjson.loads(f.read())
+        os.utime(path)   # mark as recently used for eviction
+        return value
+    except FileNotFoundError:
+        return None
+    except Exception as exc:
+        print(f"[worker] Ignoring unreadable cache entry {name}: {exc}")
+        return None
+
+
+def _cache_store(name: str, value: list) -> None:
+    os.makedirs(EXTRACT_CACHE_DIR, exist_ok=True)
+    path = os.path.join(EXTRACT_CACHE_DIR, name)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(value))
+    os.replace(tmp, path)   # atomic — readers never see a half-written file
+    _cache_evict()
+
+
+def _cache_evict() -> None:
+    """Keep the EXTRACT_CACHE_MAX_ENTRIES most recently used entries; drop legacy formats."""
+    entries = []
+    for entry in os.scandir(EXTRACT_CACHE_DIR):
+        if entry.name.endswith(".tmp"):
+            continue   # another thread's write in progress
+        if not entry.name.endswith(".chunks.json"):
+            with suppress(FileNotFoundError):
+                os.remove(entry.path)
+            continue
+        with suppress(FileNotFoundError):
+            entries.append((entry.stat().st_mtime, entry.path))
+    entries.sort(reverse=True)
+    for _, path in entries[EXTRACT_CACHE_MAX_ENTRIES:]:
+        with suppress(FileNotFoundError):
+            os.remove(path)
+
+
+def _cache_discard(file_path: str) -> None:
+    """Remove every cache entry for file_path's contents."""
+    if not os.path.isdir(EXTRACT_CACHE_DIR):
+        return
+    digest = _file_sha256(file_path)
+    for entry in os.scandir(EXTRACT_CACHE_DIR):
+        if entry.name.startswith(digest):
+            with suppress(FileNotFoundError):
+                os.remove(entry.path)
+
+
+def _load_and_split_cached(file_path: str) -> list:
+    """_load_and_split, skipping PyPDF when the same bytes were split before."""
+    # Every setting that shapes the chunks is part of the key
+    model = EMBED_MODEL.replace("/", "_")
+    name = (
+        f"{_file_sha256(file_path)}-{model}-tok{CHUNK_SIZE}-{CHUNK_OVERLAP}"
+        f"-{CHUNK_MIN_TOKENS}-{CHUNK_MAX_TOKENS}.chunks.json"
+    )
+    cached = _cache_load(name)
+    if cached is None:
+        chunks = _load_and_split(file_path)
+        # Plain JSON, not pickled Documents — nothing executable lives under uploads/
+        _cache_store(name, [
+            {"page_content": c.page_content, "metadata": c.metadata} for c in chunks
+        ])
+        return chunks
+    chunks = [Document(page_content=c["page_content"], metadata=c["metadata"]) for c in cached]
+    # The same bytes may have been uploaded under a different name
+    for c in chunks:
+        c.metadata["source"] = file_path
+    print(f"[worker] Reused cached chunks for {os.path.basename(file_path)}")
+    return chunks
+
+
+async def _upsert_tracked(
+    client: AsyncQdrantClient, points: list[PointStruct], wait: bool, created: set[str],
+) -> None:
+    """
+    Upsert points, first adding the IDs Qdrant doesn't hold yet to `created`.
+    IDs are deterministic, so a re-ingest overwrites existing points — those
+    must survive if this run fails; only the new ones are its to clean up.
+    """
+    ids = [p.id for p in points]
+    existing = await client.retrieve(
+        collection_name=COLLECTION, ids=ids, with_payload=False, with_vectors=False,
+    )
+    created.update(set(ids) - {str(r.id) for r in existing})
+    await client.upsert(collection_name=COLLECTION, points=points, wait=wait)
+
+
+async def _upsert_batched(
+    points: list[PointStruct], created: set[str], batch_size: int = 64, concurrency: int = 2,
+) -> None:
+    """
+    Upsert points in batches with at most `concurrency` requests in flight.
+    All but the last batch go out with wait=False; the last is sent once the
+    others have been accepted and waits, so it returns after all are applied.
+    IDs of points that didn't exist before are added to `created`.
+    """
+    if not points:
+        return
+    client = get_async_qdrant_client()
+    batches = [points[i:i + batch_size] for i in range(0, len(points), batch_size)]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _send(batch: list[PointStruct], wait: bool) -> None:
+        async with semaphore:
+            await _upsert_tracked(client, batch, wait, created)
+
+    # Let every batch settle before raising, so a failed ingest's cleanup can't
+    # race batches that are still in flight
+    results = await asyncio.gather(*(_send(b, False) for b in batches[:-1]), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    await _send(batches[-1], True)
+
+
+# Point IDs are derived from (filename, chunk index, chunk text), so re-ingesting
+# the same PDF — or retrying a timed-out upsert — overwrites instead of duplicating
+_POINT_ID_NAMESPACE = uuid.UUID("6ba7b810-9dad-11d1-80b4-00c04fd430c8")
+
+
+def _point_id(filename: str, index: int, text: str) -> str:
+    digest = hashlib.sha1(text.encode()).hexdigest()
+    return str(uuid.uuid5(_POINT_ID_NAMESPACE, f"{filename}|{index}|{digest}"))
+
+
+def _make_points(
+    chunks: list, indices: list[int], vectors: np.ndarray, filename: str,
+) -> list[PointStruct]:
+    """Build points for chunks[indices[j]] with vectors[j]."""
+    return [
+        PointStruct(
+            id=_point_id(filename, i, chunks[i].page_content),
+            vector=vec,
+            payload={
+                "page_content": chunks[i].page_content,
+                "metadata": chunks[i].metadata,
+                "filename": filename,   # enables per-PDF filtered retrieval
+            },
+        )
+        # PointStruct needs plain floats — convert the whole matrix in one call
+        for i, vec in zip(indices, vectors.tolist())
+    ]
+
+
+async def _embed_and_upsert_pipelined(
+    chunks: list, filename: str, parallel: int | None, created: set[str],
+) -> None:
+    """
+    Overlap embedding and upserting: a single embed thread streams
+    PIPELINE_BATCH-sized slices into a bounded queue (at most two slices in
+    memory) while the event loop upserts the previous slice.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue[tuple[list[int], np.ndarray] | None] = asyncio.Queue(maxsize=2)
+    stop = threading.Event()
+    texts = [c.page_content for c in chunks]
+
+    def produce() -> None:
+        try:
+            for item in _embed_bulk_stream(texts, parallel, PIPELINE_BATCH):
+                if stop.is_set():
+                    return
+                asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+        finally:
+            asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+
+    producer = loop.run_in_executor(_embed_executor, produce)
+    client = get_async_qdrant_client()
+    done = 0
+    held: list[PointStruct] | None = None
+    try:
+        while (item := await queue.get()) is not None:
+            indices, vectors = item
+            points = _make_points(chunks, indices, vectors, filename)
+            done += len(indices)
+            # Hold one slice back so the final upsert can be sent with wait=True
+            if held is not None:
+                await _upsert_tracked(client, held, False, created)
+            held = points
+        # The producer enqueues None even when it fails — surface its error
+        # before the final upsert rather than after it
+        await producer
+        if held is not None:
+            await _upsert_tracked(client, held, True, created)
+    except BaseException:
+        # Unblock the producer so its thread can exit, then re-raise
+        stop.set()
+        while not producer.done():
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.sleep(0.01)
+        raise
+    print(f"[worker] Embedded and upserted {done} chunks (pipelined)")
+
+
+# Bulk ingests pause indexing collection-wide, so they are reference-counted:
+# the first one saves the threshold, the last one to finish restores it
+_bulk_ingests = 0
+_bulk_ingests_lock = asyncio.Lock()
+_saved_indexing_threshold: int | None = None
+
+
+@asynccontextmanager
+async def _bulk_indexing_paused():
+    global _bulk_ingests, _saved_indexing_threshold
+    aclient = get_async_qdrant_client()
+    async with _bulk_ingests_lock:
+        if _bulk_ingests == 0:
+            info = await aclient.get_collection(COLLECTION)
+            threshold = info.config.optimizer_config.indexing_threshold
+            # 0 means an earlier run died while paused — don't make that permanent
+            _saved_indexing_threshold = threshold or INDEXING_THRESHOLD
+            await aclient.update_collection(
+                collection_name=COLLECTION,
+                optimizers_config=OptimizersConfigDiff(indexing_threshold=0),
+            )
+        _bulk_ingests += 1
+    try:
+        yield
+    finally:
+        async with _bulk_ingests_lock:
+            _bulk_ingests -= 1
+            if _bulk_ingests == 0:
+                await aclient.update_collection(
+                    collection_name=COLLECTION,
+                    optimizers_config=OptimizersConfigDiff(indexing_threshold=_saved_indexing_threshold),
+                )
+
+
+async def process_pdf(file_path: str):
+    """
+    Load, chunk and embed a PDF file into Qdrant. Called as a background task.
+    Runs on the server's event loop; CPU-bound steps are pushed to threads.
+    """
     filename = os.path.basename(file_path)
-    _ensure_pdfs_loaded()  # Recover list from Qdrant if this is a fresh process
+    await asyncio.to_thread(_ensure_pdfs_loaded)  # Recover list from Qdrant if this is a fresh process
     with _embedding_lock:
         _embedding_status[filename] = 'processing'
     print(f"[worker] Processing: {file_path}")
 
+    created: set[str] = set()   # IDs of points this run added — removed if it fails
     try:
         # Ensure collection exists (multi-PDF mode — no reset)
         client = get_qdrant_client()
-        ensure_collection(client)
+        await asyncio.to_thread(ensure_collection, client)
 
-        # ── 1. Load ──────────────────────────────────────────────────────────
-        loader = PyPDFLoader(file_path)
-        docs = loader.load()
-
-        # ── 2. Split — larger chunks + less overlap → fewer embedding calls ──
-        splitter = RecursiveCharacterTextSplitter(chunk_size=4000, chunk_overlap=200)
-        chunks = splitter.split_documents(docs)
+        # ── 1+2. Load and split ──────────────────────────────────────────────
+        chunks = await asyncio.to_thread(_load_and_split_cached, file_path)
         print(f"[worker] Split into {len(chunks)} chunks")
 
-        # ── 3. Batch-embed via Ollama native API (all texts in one HTTP call) ─
-        texts = [c.page_content for c in chunks]
-        vectors = _batch_embed(texts)
-        print(f"[worker] Embedded {len(vectors)} chunks via batch API")
-
-        # ── 4. Batch-upsert to Qdrant in ONE request ─────────────────────────
-        points = [
-            PointStruct(
-                id=str(uuid.uuid4()),
-                vector=vec,
-                payload={
-                    "page_content": chunks[i].page_content,
-                    "metadata": chunks[i].metadata,
-                    "filename": filename,   # enables per-PDF filtered retrieval
-                },
-            )
-            for i, vec in enumerate(vectors)
-        ]
-        client.upsert(collection_name=COLLECTION, points=points, wait=True)
-        print(f"[worker] Done — {len(points)} points upserted to Qdrant.")
-
-        # Invalidate cached vector store so next query uses fresh data
-        global _vector_store
-        _vector_store = None
+        # ── 3+4. Embed locally via FastEmbed and upsert to Qdrant ────────────
+        parallel = _embed_parallelism(len(chunks))
+        bulk = len(chunks) >= BULK_INDEXING_MIN_POINTS
+        # Large ingest: append to unindexed segments, build HNSW once at the end
+        async with _bulk_indexing_paused() if bulk else nullcontext():
+            if len(chunks) < PIPELINE_MIN_CHUNKS:
+                # Small PDF — embed everything, then upsert in one go
+                texts = [c.page_content for c in chunks]
+                vectors = await asyncio.get_running_loop().run_in_executor(
+                    _embed_executor, _batch_embed_bulk, texts, parallel
+                )
+                points = _make_points(chunks, range(len(chunks)), vectors, filename)
+                await _upsert_batched(points, created)
+            else:
+                await _embed_and_upsert_pipelined(chunks, filename, parallel, created)
+        print(f"[worker] Done — {len(chunks)} points upserted to Qdrant.")
 
+        _invalidate_retrieval_cache(filename)
         with _embedding_lock:
             _embedding_status[filename] = 'done'
-        if _embedded_pdfs is not None and filename not in _embedded_pdfs:
-            _embedded_pdfs.append(filename)
+            if _embedded_pdfs is not None:
+                _embedded_pdfs.add(filename)
 
     except Exception as exc:
+        # An earlier successful ingest of this file stays listed — its points are kept
         with _embedding_lock:
             _embedding_status[filename] = 'error'
         print(f"[worker] Embedding error: {exc}")
+        await _discard_partial_ingest(filename, created)
         raise
 
 
+async def _discard_partial_ingest(filename: str, created: set[str]) -> None:
+    """Delete the points a failed process_pdf added, so they can't feed retrieval."""
+    if not created:
+        return
+    try:
+        await get_async_qdrant_client().delete(
+            collection_name=COLLECTION,
+            points_selector=PointIdsList(points=list(created)),
+        )
+    except Exception as exc:
+        print(f"[worker] Could not remove partial points for {filename}: {exc}")
+    _invalidate_retrieval_cache(filename)
+
+
+# ── Retrieval cache — follow-ups ("continue", "elaborate") repeat a search ────
+# (normalized query, sorted active PDFs) -> (hits, stored_at), oldest first
+_retrieval_cache: OrderedDict[tuple, tuple[list, float]] = OrderedDict()
+_retrieval_cache_lock = threading.Lock()
+# Bumped on every invalidation — lets a search that was already in flight
+# notice that its result is stale before caching it
+_retrieval_generations: dict[str, int] = {}
+
+
+def _retrieval_cache_get(key: tuple) -> list | None:
+    with _retrieval_cache_lock:
+        entry = _retrieval_cache.get(key)
+        if entry is None:
+            return None
+        hits, stored_at = entry
+        if time.monotonic() - stored_at > RETRIEVAL_CACHE_TTL:
+            del _retrieval_cache[key]
+            return None
+        _retrieval_cache.move_to_end(key)
+        return hits
+
+
+def _retrieval_generation(filenames: tuple) -> tuple[int, ...]:
+    with _retrieval_cache_lock:
+        return tuple(_retrieval_generations.get(f, 0) for f in filenames)
+
+
+def _retrieval_cache_put(key: tuple, hits: list, generation: tuple[int, ...]) -> None:
+    with _retrieval_cache_lock:
+        if generation != tuple(_retrieval_generations.get(f, 0) for f in key[1]):
+            return   # a file was (re)ingested or deleted while the search ran
+        _retrieval_cache[key] = (hits, time.monotonic())
+        _retrieval_cache.move_to_end(key)
+        while len(_retrieval_cache) > RETRIEVAL_CACHE_MAX:
+            _retrieval_cache.popitem(last=False)
+
+
+def _invalidate_retrieval_cache(filename: str) -> None:
+    """Drop cached searches over filename — its points were just added or removed."""
+    with _retrieval_cache_lock:
+        _retrieval_generations[filename] = _retrieval_generations.get(filename, 0) + 1
+        for key in [k for k in _retrieval_cache if filename in k[1]]:
+            del _retrieval_cache[key]
+
+
 # ── Chat helpers ─────────────────────────────────────────────────────────────
 
 def _retrieve_per_pdf(
@@ -238,50 +755,57 @@ def _retrieve_per_pdf(
     k_per_pdf: int = 4,
 ) -> list:
     """
-    For each filename in active_pdfs, run a Qdrant similarity search filtered
-    to only that file's chunks.  This guarantees every uploaded PDF contributes
-    to the context regardless of relative similarity scores.
-    Falls back to a global (unfiltered) search if a filtered search returns
-    nothing (e.g. older points that pre-date the 'filename' payload field).
+    Run one Qdrant similarity search grouped by filename over active_pdfs, so
+    every uploaded PDF contributes up to k_per_pdf chunks to the context
+    regardless of relative similarity scores.
+    Falls back to a global (unfiltered) search if some file returns no hits
+    (e.g. older points that pre-date the 'filename' payload field).
     """
     client = get_qdrant_client()
-    # Embed the query once and reuse for every per-PDF search
-    query_vector = _batch_embed([query_text])[0]
+    query_vector = _embed_query(query_text)
 
-    all_docs = []
-    seen_ids: set[str] = set()
+    # One grouped query instead of one per file — Qdrant returns up to
+    # k_per_pdf hits for every filename in active_pdfs
+    resp = client.query_points_groups(
+        collection_name=COLLECTION,
+        query=query_vector,
+        group_by="filename",
+        query_filter=Filter(
+            must=[FieldCondition(key="filename", match=MatchAny(any=active_pdfs))]
+        ),
+        group_size=k_per_pdf,
+        limit=len(active_pdfs),
+        with_payload=True,
+    )
+    all_docs = [h for group in resp.groups for h in group.hits]
 
-    for fname in active_pdfs:
+    if len(resp.groups) < len(active_pdfs):
+        # Fallback: some files had no filtered hits — they may have been embedded
+        # before the 'filename' field was added; include global top results instead
+        seen_ids = {h.id for h in all_docs}
         resp = client.query_points(
             collection_name=COLLECTION,
             query=query_vector,
-            query_filter=Filter(
-                must=[
-                    FieldCondition(key="filename", match=MatchValue(value=fname))
-                ]
-            ),
             limit=k_per_pdf,
             with_payload=True,
         )
-        hits = resp.points
-        if not hits:
-            # Fallback: no filtered hits — file may have been embedded before
-            # the 'filename' field was added; include global top results instead
-            resp = client.query_points(
-                collection_name=COLLECTION,
-                query=query_vector,
-                limit=k_per_pdf,
-                with_payload=True,
-            )
-            hits = resp.points
-        for h in hits:
-            if h.id not in seen_ids:
-                seen_ids.add(h.id)
-                all_docs.append(h)
+        all_docs.extend(h for h in resp.points if h.id not in seen_ids)
 
     return all_docs
 
 
+async def _retrieve_global(query_text: str, k: int = 6) -> list:
+    """Unfiltered top-k similarity search across every embedded PDF."""
+    query_vector = await asyncio.to_thread(_embed_query, query_text)
+    resp = await get_async_qdrant_client().query_points(
+        collection_name=COLLECTION,
+        query=query_vector,
+        limit=k,
+        with_payload=True,
+    )
+    return resp.points
+
+
 def _build_messages(context: str, query: str, history: list[dict] | None = None, num_pdfs: int = 1) -> list:
     """Build the message list sent to the LLM, including conversation history (#9)."""
     if num_pdfs == 0 or not context.strip():
@@ -316,13 +840,13 @@ def _build_messages(context: str, query: str, history: list[dict] | None = None,
 
 
 async def chat_with_pdf(query: str) -> dict:
-    store = get_vector_store()
-    relevant_docs = await store.as_retriever(search_kwargs={"k": 4}).ainvoke(query)
-    context = "\n\n".join(doc.page_content for doc in relevant_docs)
+    hits = await _retrieve_global(query, k=4)
+    payloads = [h.payload or {} for h in hits]
+    context = "\n\n".join(p.get("page_content", "") for p in payloads)
     response = await get_llm().ainvoke(_build_messages(context, query))
     return {
         "message": response.content,
-        "docs": [{"content": d.page_content, "metadata": d.metadata} for d in relevant_docs],
+        "docs": [{"content": p.get("page_content", ""), "metadata": p.get("metadata", {})} for p in payloads],
     }
 
 
@@ -333,58 +857,62 @@ async def stream_chat_with_pdf(
 ):
     """Yields typed event dicts: {type: 'token', data: str} and {type: 'sources', data: list}."""
 
-    QDRANT_TIMEOUT = 12  # seconds — fail fast on Render free tier instead of hanging
     _ensure_pdfs_loaded()  # ensure list is populated after a cold restart
 
     if active_pdfs:
         # Per-PDF filtered retrieval — guarantees every file contributes chunks
-        try:
-            raw_hits = await asyncio.wait_for(
-                asyncio.get_running_loop().run_in_executor(
-                    None, _retrieve_per_pdf, query, active_pdfs
-                ),
-                timeout=QDRANT_TIMEOUT,
-            )
-        except asyncio.TimeoutError:
-            raw_hits = []
-            print("[worker] Qdrant query timed out — answering without PDF context.")
+        cache_key = (_normalize_query(query), tuple(sorted(active_pdfs)))
+        raw_hits = _retrieval_cache_get(cache_key)
+        if raw_hits is None:
+            generation = _retrieval_generation(cache_key[1])
+            try:
+                raw_hits = await asyncio.wait_for(
+                    asyncio.get_running_loop().run_in_executor(
+                        None, _retrieve_per_pdf, query, active_pdfs
+                    ),
+                    timeout=QDRANT_TIMEOUT,
+                )
+                _retrieval_cache_put(cache_key, raw_hits, generation)
+            except asyncio.TimeoutError:
+                raw_hits = []
+                print("[worker] Qdrant query timed out — answering without PDF context.")
 
         # Build context and source list from raw Qdrant ScoredPoint objects
         context_parts = []
         sources = []
         for h in raw_hits:
             payload = h.payload or {}
-            text = payload.get("page_content", "")
-            meta = payload.get("metadata", {})
-            fname = payload.get("filename", os.path.basename(meta.get("source", "unknown.pdf")))
+            text = payload.get("page_content") or ""
+            meta = payload.get("metadata") or {}
+            fname = payload.get("filename")
+            if fname is None:   # points that pre-date the 'filename' field
+                fname = os.path.basename(meta.get("source", "unknown.pdf"))
             context_parts.append(f"[{fname}]\n{text}")
             sources.append({
                 "page": meta.get("page", "?"),
                 "source": fname,
-                "snippet": text[:200] + ("…" if len(text) > 200 else ""),
+                "snippet": text if len(text) <= 200 else text[:200] + "…",
             })
         context = "\n\n".join(context_parts)
         num_pdfs = len(active_pdfs)
     elif _embedded_pdfs:
         # PDFs exist in Qdrant but none is explicitly active — global fallback
         try:
-            store = get_vector_store()
-            relevant_docs = await asyncio.wait_for(
-                store.as_retriever(search_kwargs={"k": 6}).ainvoke(query),
-                timeout=QDRANT_TIMEOUT,
-            )
+            hits = await asyncio.wait_for(_retrieve_global(query, k=6), timeout=QDRANT_TIMEOUT)
         except asyncio.TimeoutError:
-            relevant_docs = []
+            hits = []
             print("[worker] Qdrant global query timed out — answering without PDF context.")
-        context = "\n\n".join(doc.page_content for doc in relevant_docs)
-        sources = [
-            {
-                "page": d.metadata.get("page", "?"),
-                "source": os.path.basename(d.metadata.get("source", "unknown.pdf")),
-                "snippet": d.page_content[:200] + ("…" if len(d.page_content) > 200 else ""),
-            }
-            for d in relevant_docs
-        ]
+        payloads = [h.payload or {} for h in hits]
+        context = "\n\n".join(p.get("page_content", "") for p in payloads)
+        sources = []
+        for p in payloads:
+            text = p.get("page_content", "")
+            meta = p.get("metadata", {})
+            sources.append({
+                "page": meta.get("page", "?"),
+                "source": os.path.basename(meta.get("source", "unknown.pdf")),
+                "snippet": text[:200] + ("…" if len(text) > 200 else ""),
+            })
         num_pdfs = 1
     else:
         # No PDFs uploaded at all — answer directly without touching Qdrant
@@ -432,41 +960,51 @@ async def get_suggestions(query: str, answer: str) -> list[str]:
 def list_embedded_pdfs() -> list[str]:
     """Return basenames of all successfully embedded PDFs. Lazily reloaded from Qdrant on restart."""
     _ensure_pdfs_loaded()
-    return list(_embedded_pdfs or [])
+    with _embedding_lock:
+        return sorted(_embedded_pdfs or ())
 
 
 def delete_pdf_from_collection(filename: str) -> None:
     """Remove all Qdrant vectors for the given PDF and delete the file from disk."""
-    global _embedded_pdfs
     client = get_qdrant_client()
     existing = [c.name for c in client.get_collections().collections]
     if COLLECTION not in existing:
         return
 
-    # Fast filter-based deletion — no full-collection scroll needed
+    # Fast filter-based deletion — no full-collection scroll needed.
+    # Points that pre-date the 'filename' field only carry the loader's full
+    # path in metadata.source, so match either.
     client.delete(
         collection_name=COLLECTION,
         points_selector=FilterSelector(
             filter=Filter(
-                must=[FieldCondition(key="filename", match=MatchValue(value=filename))]
+                should=[
+                    FieldCondition(key="filename", match=MatchValue(value=filename)),
+                    FieldCondition(
+                        key="metadata.source",
+                        match=MatchValue(value=os.path.join(UPLOAD_DIR, filename)),
+                    ),
+                ]
             )
         ),
     )
 
+    _invalidate_retrieval_cache(filename)
+    _ensure_pdfs_loaded()
     with _embedding_lock:
         _embedding_status.pop(filename, None)
-    _ensure_pdfs_loaded()
-    _embedded_pdfs = [f for f in (_embedded_pdfs or []) if f != filename]
+        _embedded_pdfs.discard(filename)
 
     fpath = os.path.join(UPLOAD_DIR, filename)
     if os.path.exists(fpath):
+        _cache_discard(fpath)
         os.remove(fpath)
     print(f"[worker] Deleted PDF: {filename}")
 
 
 def merge_pdfs(filenames: list[str], output_name: str) -> str:
     """Merge multiple PDFs by page order and return the output file path."""
-    from pypdf import PdfReader, PdfWriter
+    from pypdf import PdfWriter
     if not output_name.endswith(".pdf"):
         output_name += ".pdf"
     output_path = os.path.join(UPLOAD_DIR, output_name)
@@ -475,28 +1013,17 @@ def merge_pdfs(filenames: list[str], output_name: str) -> str:
         fpath = os.path.join(UPLOAD_DIR, fname)
         if not os.path.exists(fpath):
             raise FileNotFoundError(f"File not found: {fname}")
-        reader = PdfReader(fpath)
-        for page in reader.pages:
-            writer.add_page(page)
+        # One pass per file; objects shared between its pages are copied once
+        writer.append(fpath)
     with open(output_path, "wb") as f:
         writer.write(f)
+    writer.close()
     print(f"[worker] Merged {len(filenames)} PDFs \u2192 {output_name}")
     return output_path
 
 
-async def translate_pdf_stream(filename: str, target_language: str):
-    """Extract text from a PDF and stream its translation to target_language."""
-    fpath = os.path.join(UPLOAD_DIR, filename)
-    if not os.path.exists(fpath):
-        yield {"type": "token", "data": f"Error: file \u2018{filename}\u2019 not found."}
-        return
-
-    loader = PyPDFLoader(fpath)
-    docs = loader.load()
-    raw_text = "\n\n".join(doc.page_content for doc in docs)
-
-    # ── Clean PDF-extracted text ──────────────────────────────────────────
-    import re
+def _clean_extracted_text(raw_text: str) -> str:
+    """Undo PDF line wrapping and hyphenation in PyPDF output."""
     # Replace soft hyphens / hyphenated line-breaks (word- \n word → wordword)
     cleaned = re.sub(r'-\n(\S)', r'\1', raw_text)
     # Merge single newlines within a paragraph into a space (PDF line wrapping)
@@ -505,9 +1032,37 @@ async def translate_pdf_stream(filename: str, target_language: str):
     cleaned = re.sub(r'\n{3,}', '\n\n', cleaned)
     # Remove excessive spaces
     cleaned = re.sub(r'[ \t]{2,}', ' ', cleaned)
-    full_text = cleaned.strip()
+    return cleaned.strip()
+
+
+def _read_text_prefix(file_path: str, max_chars: int) -> str:
+    """
+    Extract and clean PDF text page by page, stopping as soon as it exceeds
+    max_chars — the rest of the document is never parsed.
+    """
+    from pypdf import PdfReader
+    pages: list[str] = []
+    raw_len = 0
+    for page in PdfReader(file_path).pages:
+        pages.append(page.extract_text() or "")
+        raw_len += len(pages[-1])
+        # Cleaning only shrinks text, so skip it until the raw text is long enough
+        if raw_len > max_chars:
+            text = _clean_extracted_text("\n\n".join(pages))
+            if len(text) > max_chars:
+                return text
+    return _clean_extracted_text("\n\n".join(pages))
+
+
+async def translate_pdf_stream(filename: str, target_language: str):
+    """Extract text from a PDF and stream its translation to target_language."""
+    fpath = os.path.join(UPLOAD_DIR, filename)
+    if not os.path.exists(fpath):
+        yield {"type": "token", "data": f"Error: file \u2018{filename}\u2019 not found."}
+        return
 
     MAX_CHARS = 6000
+    full_text = await asyncio.to_thread(_read_text_prefix, fpath, MAX_CHARS)
     truncated = len(full_text) > MAX_CHARS
     if truncated:
         # Cut at the last whitespace before the limit to avoid mid-word splits